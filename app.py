@@ -5,16 +5,30 @@ A beginner-friendly email receiving application with real-time updates
 
 import sqlite3
 from flask import Flask, render_template, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
 import os
 from datetime import datetime
 import imaplib
 import email
+import email.policy
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 import logging
 from dotenv import load_dotenv
+import orjson
 import threading
 import time
+import re
+import uuid
+import codecs
+import binascii
+import quopri
+import zlib
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
@@ -23,10 +37,35 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes and decodes with orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, no str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        option = orjson.OPT_INDENT_2 if self._app.debug else 0
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=option),
+                                        mimetype=self.mimetype)
+
 # Initialize Flask app
 app = Flask(__name__, template_folder='.')
+# Match /api/emails/ and /api/emails alike instead of redirecting
+app.url_map.strict_slashes = False
+app.json = ORJSONProvider(app)
 CORS(app)
 
+# Compress larger responses, small ones aren't worth the CPU
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_BR_LEVEL'] = 4
+Compress(app)
+
 # SQLite Configuration
 # Using /tmp for Vercel serverless functions as it's the only writable directory
 if os.environ.get('VERCEL'):
@@ -35,17 +74,61 @@ else:
     DB_PATH = os.path.join('instance', 'vexmail.db')
     os.makedirs('instance', exist_ok=True)
 
+# Characters of body text stored as the list view preview
+PREVIEW_CHARS = 100
+
+# Seconds a connection waits for a lock held by another writer
+SQLITE_TIMEOUT = float(os.getenv('SQLITE_TIMEOUT', '15'))
+
+# One long-lived connection per thread instead of reconnecting on every request
+db_local = threading.local()
+
 def get_db_connection():
-    """Get a connection to the SQLite database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Get this thread's connection to the SQLite database"""
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        # Room for every distinct query the app runs, so none are re-prepared.
+        # The timeout waits out the sync writer instead of failing with "database is locked"
+        conn = sqlite3.connect(DB_PATH, timeout=SQLITE_TIMEOUT, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        # WAL only needs an fsync on checkpoint, not on every commit
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA cache_size=-20000')
+        db_local.conn = conn
     return conn
 
+def get_db_version(conn):
+    """Token that changes whenever the database is written, by any connection
+
+    data_version moves when other connections commit, total_changes when
+    this one does.
+    """
+    return conn.execute('PRAGMA data_version').fetchone()[0], conn.total_changes
+
+def email_body(body_z, body):
+    """Decompress a stored body, rows synced before compression keep it in plain text"""
+    if body_z is not None:
+        return zlib.decompress(body_z).decode('utf-8')
+    return body
+
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    """Roll back anything a failed request left open, the connection itself is kept"""
+    conn = getattr(db_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
 def init_db():
     """Initialize the SQLite database with the required table"""
     print(f"[Vexmail] Initializing database at {DB_PATH}...")
     conn = get_db_connection()
     cursor = conn.cursor()
+
+    # WAL is persistent, so it only has to be enabled once per database file
+    journal_mode = cursor.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+    print(f"[Vexmail] SQLite journal mode: {journal_mode}")
     
     # Check if table exists and has the right schema
     try:
@@ -65,11 +148,42 @@ def init_db():
                 body TEXT,
                 is_read BOOLEAN DEFAULT 0,
                 is_starred BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                uid_int INTEGER,
+                preview TEXT,
+                body_z BLOB
             )
         ''')
+
+    # Add columns introduced after the table was first created
+    columns = {row['name'] for row in cursor.execute('PRAGMA table_info(emails)')}
+    if 'uid_int' not in columns:
+        cursor.execute('ALTER TABLE emails ADD COLUMN uid_int INTEGER')
+        cursor.execute('UPDATE emails SET uid_int = CAST(email_id AS INTEGER)')
+    if 'preview' not in columns:
+        cursor.execute('ALTER TABLE emails ADD COLUMN preview TEXT')
+        cursor.execute('UPDATE emails SET preview = substr(body, 1, ?)', (PREVIEW_CHARS,))
+    if 'body_z' not in columns:
+        cursor.execute('ALTER TABLE emails ADD COLUMN body_z BLOB')
+
+    # Single-row table remembering how far sync has got
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_uid INTEGER,
+            uid_validity INTEGER
+        )
+    ''')
+    sync_columns = {row['name'] for row in cursor.execute('PRAGMA table_info(sync_state)')}
+    if 'uid_validity' not in sync_columns:
+        cursor.execute('ALTER TABLE sync_state ADD COLUMN uid_validity INTEGER')
+
+    # Numeric UID index so the listing is an index walk instead of a full sort
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_uid_int ON emails(uid_int DESC)')
+    # Partial indexes only hold the unread/starred rows that the stats count
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_unread ON emails(id) WHERE is_read = 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_starred ON emails(id) WHERE is_starred = 1')
     conn.commit()
-    conn.close()
     print("[Vexmail] Database initialized.")
 
 # Initialize DB on import for Vercel
@@ -79,10 +193,64 @@ init_db()
 IMAP_SERVER = os.getenv('IMAP_SERVER', 'imap.gmail.com')
 EMAIL_USER = os.getenv('EMAIL_USER', '')
 EMAIL_PASS = os.getenv('EMAIL_PASS', '')
+# Number of UIDs requested per IMAP FETCH command
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', '100'))
+# Threads used to parse fetched messages
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', '4'))
+
+# Bytes of message text to download, enough for the 5000 character preview
+# plus MIME part headers, without pulling down attachments
+BODY_FETCH_BYTES = int(os.getenv('BODY_FETCH_BYTES', '16384'))
+MAX_BODY_CHARS = 5000
+# Emails returned per page of the list view
+PAGE_SIZE = 50
+
+# Flags, the headers we store (plus MIME structure) and the first part of the text.
+# BODY.PEEK leaves the \Seen flag untouched on the server.
+FETCH_ITEMS = ('(FLAGS BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE MIME-VERSION CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] '
+               f'BODY.PEEK[TEXT]<0.{BODY_FETCH_BYTES}>)')
+
+UID_PATTERN = re.compile(rb'UID (\d+)')
+MESSAGE_START_PATTERN = re.compile(rb'\d+ \(')
+FLAGS_PATTERN = re.compile(rb'FLAGS \(([^)]*)\)')
+# ?before= cursors are IMAP UIDs, which fit in 32 bits
+UID_CURSOR_PATTERN = re.compile(r'[0-9]{1,10}')
+# The body window can end anywhere inside an encoded part
+BASE64_JUNK_PATTERN = re.compile(r'[^A-Za-z0-9+/=]')
+QP_CUT_ESCAPE_PATTERN = re.compile(r'=[0-9A-Fa-f]?\Z')
+HEADER_PARSER = BytesHeaderParser()
+
+# Serverless functions stop once the response is sent, so sync inline there
+BACKGROUND_SYNC = not os.environ.get('VERCEL')
+MAX_SYNC_JOBS = 100
+
+# Push sync: keep an IMAP connection in IDLE instead of waiting for a manual or cron sync
+IMAP_IDLE = os.getenv('IMAP_IDLE', 'false').lower() == 'true'
+# Gmail drops idle connections after about 10 minutes, so re-issue IDLE before that
+IDLE_REFRESH_SECONDS = 9 * 60
+# imaplib only supports IDLE from Python 3.14, older versions poll with NOOP instead
+NOOP_POLL_SECONDS = 30
+IDLE_RETRY_SECONDS = 30
+
+# Local server: Flask's reloading dev server when debugging, waitress otherwise
+DEBUG = os.getenv('FLASK_DEBUG', 'false').lower() in ('1', 'true')
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', '8'))
+
+# Opening emails marks them read through a short write-behind buffer
+BUFFER_READ_MARKS = BACKGROUND_SYNC
+READ_FLUSH_INTERVAL = 0.5
+READ_FLUSH_SIZE = 32
 
 # Vexmail Global State
 last_sync_time = None
 sync_lock = threading.Lock()
+sync_executor = ThreadPoolExecutor(max_workers=1)
+parse_executor = ThreadPoolExecutor(max_workers=PARSE_WORKERS)
+sync_jobs = {}
+sync_jobs_lock = threading.Lock()
+read_marks = set()
+read_marks_cond = threading.Condition()
+read_marks_flush_lock = threading.Lock()
 
 def connect_to_imap():
     """Connect to IMAP server and return connection"""
@@ -95,142 +263,513 @@ def connect_to_imap():
         mail = imaplib.IMAP4_SSL(IMAP_SERVER)
         mail.login(EMAIL_USER, EMAIL_PASS)
         mail.select('inbox')
+        # SELECT already reports UIDVALIDITY, keep it for sync
+        mail.uid_validity = get_uid_validity(mail)
         return mail
     except Exception as e:
         logger.error(f"Failed to connect to IMAP: {e}")
         return None
 
+def close_imap(mail):
+    """Close and log out of an IMAP connection, ignoring a connection that already dropped"""
+    try:
+        mail.close()
+        mail.logout()
+    except Exception as e:
+        logger.warning(f"Failed to close IMAP connection: {e}")
+
+@lru_cache(maxsize=64)
+def lookup_codec(charset):
+    """Resolve a charset name to a text codec, falling back to UTF-8 for unknown ones"""
+    try:
+        codec = codecs.lookup(charset or 'utf-8')
+    except LookupError:
+        return 'utf-8'
+    # bytes-to-bytes codecs like base64 or hex are not charsets, bytes.decode() rejects them
+    return codec.name if codec._is_text_encoding else 'utf-8'
+
 def decode_email_header(header):
     """Decode email header to readable text"""
     if header is None:
         return ""
 
+    # Most headers are plain text with no encoded words to decode
+    if isinstance(header, str) and '=?' not in header:
+        return header
+
     decoded_parts = decode_header(header)
     decoded_string = ""
 
     for part, encoding in decoded_parts:
         if isinstance(part, bytes):
-            try:
-                decoded_string += part.decode(encoding or 'utf-8', errors='ignore')
-            except:
-                decoded_string += part.decode('utf-8', errors='ignore')
+            decoded_string += part.decode(lookup_codec(encoding), errors='ignore')
         else:
             decoded_string += str(part)
 
     return decoded_string
 
-def fetch_emails_from_server(limit=50):
-    """Fetch emails from IMAP server using UIDs"""
-    mail = connect_to_imap()
+def iter_fetch_response(msg_data):
+    """Yield (uid, flags, header_bytes, text_bytes) tuples from a UID FETCH response
+
+    Each message arrives as a header literal followed by a body literal,
+    which are matched back up using the UID in the response.
+    """
+    def finish(message):
+        match = UID_PATTERN.search(message['info'])
+        if match:
+            flags = FLAGS_PATTERN.search(message['info'])
+            return (match.group(1), flags.group(1).split() if flags else [],
+                    message['header'], message['text'])
+
+    message = None
+    for response_part in msg_data:
+        if isinstance(response_part, tuple):
+            info, literal = response_part
+            if MESSAGE_START_PATTERN.match(info):
+                if message:
+                    result = finish(message)
+                    if result:
+                        yield result
+                message = {'info': b'', 'header': b'', 'text': b''}
+            if message is None:
+                continue
+            message['info'] += info
+            if b'BODY[TEXT]' in info:
+                message['text'] = literal
+            else:
+                message['header'] = literal
+        elif isinstance(response_part, bytes) and message:
+            message['info'] += response_part
+
+    if message:
+        result = finish(message)
+        if result:
+            yield result
+
+def parse_later(msg_data):
+    """Hand each message of a FETCH response to the parse pool"""
+    return [parse_executor.submit(parse_email_safely, message) for message in iter_fetch_response(msg_data)]
+
+def fetch_messages(mail, uids):
+    """Fetch flags, headers and the start of the body for the given UIDs in batches
+
+    Each batch is parsed in the background while the next one downloads,
+    the returned futures resolve to parsed emails (or None).
+    """
+    messages = []
+    uids = iter(uids)
+    while True:
+        batch = list(islice(uids, FETCH_BATCH_SIZE))
+        if not batch:
+            break
+        try:
+            # One round-trip for the whole batch instead of one per email
+            status, msg_data = mail.uid('fetch', b','.join(batch), FETCH_ITEMS)
+            if status != 'OK':
+                raise imaplib.IMAP4.error(status)
+            messages.extend(parse_later(msg_data))
+        except imaplib.IMAP4.error as e:
+            # Some servers reject long UID sets, fall back to one at a time
+            logger.warning(f"Batch fetch failed ({e}), fetching one by one")
+            for uid in batch:
+                try:
+                    status, msg_data = mail.uid('fetch', uid, FETCH_ITEMS)
+                    messages.extend(parse_later(msg_data))
+                except imaplib.IMAP4.error:
+                    continue
+    return messages
+
+def decode_payload(part):
+    """Undo a part's transfer encoding, tolerating a body cut off at BODY_FETCH_BYTES
+
+    get_payload(decode=True) hands back the undecoded text when a base64
+    part ends mid-quantum, so cut encodings are trimmed before decoding.
+    """
+    encoding = part.get('content-transfer-encoding', '').strip().lower()
+    if encoding == 'base64':
+        # Keep only whole 4 character groups
+        data = BASE64_JUNK_PATTERN.sub('', part.get_payload())
+        try:
+            return binascii.a2b_base64(data[:len(data) - len(data) % 4])
+        except binascii.Error:
+            return b''
+    if encoding == 'quoted-printable':
+        # Drop an escape sequence that lost its hex digits to the cut
+        data = QP_CUT_ESCAPE_PATTERN.sub('', part.get_payload())
+        return quopri.decodestring(data.encode('ascii', errors='surrogateescape'))
+    return part.get_payload(decode=True)
+
+def parse_email(email_id, flags, header_bytes, text_bytes):
+    """Build an email record from fetched header and body bytes"""
+    # Parse just the headers, no MIME tree is built for them
+    msg = HEADER_PARSER.parsebytes(header_bytes)
+    subject = decode_email_header(msg['subject'])
+    sender = decode_email_header(msg['from'])
+    # Raw 8-bit headers come back as Header objects, which sqlite cannot bind
+    date = decode_email_header(msg['date']) or None
+
+    body = ""
+    if msg.get_content_maintype() == 'multipart':
+        # Only multipart bodies need the full parser to find the text part
+        msg = email.message_from_bytes(header_bytes + text_bytes, policy=email.policy.default)
+        part = msg.get_body(preferencelist=('plain',))
+        if part is not None:
+            payload = decode_payload(part)
+            if payload:
+                body = payload.decode(lookup_codec(part.get_content_charset()), errors='ignore')
+    else:
+        # Single part bodies are decoded straight from the fetched bytes
+        msg.set_payload(text_bytes.decode('ascii', errors='surrogateescape'))
+        payload = decode_payload(msg)
+        if payload:
+            body = payload.decode(lookup_codec(msg.get_content_charset()), errors='ignore')
+
+    return {
+        'email_id': email_id.decode(),
+        'subject': subject or '(No Subject)',
+        'sender': sender,
+        'date': date,
+        'body': body[:MAX_BODY_CHARS],
+        # Start out read if it was already read in another mail client
+        'is_read': 1 if b'\\Seen' in flags else 0,
+        'is_starred': 0
+    }
+
+def parse_email_safely(message):
+    """Parse one fetched (uid, flags, header, text) message, or return None if it is malformed"""
+    try:
+        return parse_email(*message)
+    except Exception:
+        return None
+
+def get_uid_validity(mail):
+    """Read the UIDVALIDITY sent with the last SELECT, None if the server didn't report it
+
+    UIDs are only comparable while it stays the same.
+    """
+    code, data = mail.response('UIDVALIDITY')
+    try:
+        return int(data[-1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def fetch_emails_from_server(limit=50, since_uid=None, mail=None, uid_validity=None):
+    """Fetch emails from IMAP server using UIDs, optionally only those above since_uid
+
+    since_uid is ignored when the mailbox UIDVALIDITY no longer matches
+    uid_validity. An already open connection can be passed in, it is left
+    open afterwards. Returns {'uid_validity': ..., 'emails': [...]}.
+    """
+    own_connection = mail is None
+    if own_connection:
+        mail = connect_to_imap()
     if not mail:
         return {"error": "Could not connect to email server."}
 
     try:
+        current_validity = getattr(mail, 'uid_validity', None)
+        if uid_validity and current_validity and current_validity != uid_validity:
+            # The server renumbered the mailbox, our watermark means nothing now
+            since_uid = None
+
         # Use UIDs instead of sequence numbers
-        status, messages = mail.uid('search', None, 'ALL')
-        email_ids = messages[0].split()
+        if since_uid:
+            # Only ask the server for UIDs we haven't stored yet
+            status, messages = mail.uid('search', None, f'UID {since_uid + 1}:*')
+            # "n:*" always matches the newest message, even when it is below n
+            email_ids = [uid for uid in messages[0].split() if int(uid) > since_uid]
+        else:
+            status, messages = mail.uid('search', None, 'ALL')
+            email_ids = messages[0].split()
         
         # Get latest emails (UIDs are always increasing)
         email_ids = email_ids[-limit:]
-        emails = []
-
-        for email_id in reversed(email_ids):
-            try:
-                # Fetch using UID
-                status, msg_data = mail.uid('fetch', email_id, '(RFC822)')
-
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        subject = decode_email_header(msg['subject'])
-                        sender = decode_email_header(msg['from'])
-                        date = msg['date']
-
-                        body = ""
-                        if msg.is_multipart():
-                            for part in msg.walk():
-                                if part.get_content_type() == "text/plain":
-                                    payload = part.get_payload(decode=True)
-                                    if payload:
-                                        body = payload.decode('utf-8', errors='ignore')
-                                    break
-                        else:
-                            payload = msg.get_payload(decode=True)
-                            if payload:
-                                body = payload.decode('utf-8', errors='ignore')
-
-                        email_data = {
-                            'email_id': email_id.decode(),
-                            'subject': subject or '(No Subject)',
-                            'sender': sender,
-                            'date': date,
-                            'body': body[:5000],
-                            'is_read': 0,
-                            'is_starred': 0,
-                            'created_at': datetime.now().isoformat()
-                        }
-                        emails.append(email_data)
-
-            except Exception as e:
-                continue
-
-        mail.close()
-        mail.logout()
-        return emails
+        messages = fetch_messages(mail, email_ids)
+        emails = [e for e in (future.result() for future in messages) if e]
+        return {'uid_validity': current_validity, 'emails': emails}
 
     except Exception as e:
         return {"error": str(e)}
+    finally:
+        if own_connection:
+            close_imap(mail)
+
+def sync_emails_internal(limit=50, mail=None, wait=False):
+    """Internal sync logic
+
+    Returns straight away if another sync is already running, unless wait is set.
+    A skipped sync returns None as its count so callers can tell it from an empty one.
+    """
+    if not sync_lock.acquire(blocking=wait):
+        print("[Vexmail] Sync already running, skipping")
+        return None, None
+    try:
+        return sync_new_emails(limit, mail)
+    finally:
+        sync_lock.release()
 
-def sync_emails_internal(limit=50):
-    """Internal sync logic"""
+def sync_new_emails(limit, mail):
+    """Fetch emails above the stored watermark and insert them"""
     global last_sync_time
-    with sync_lock:
-        emails = fetch_emails_from_server(limit=limit)
-        if isinstance(emails, dict) and 'error' in emails:
-            return 0, emails['error']
+    conn = get_db_connection()
+    try:
+        # Highest UID synced so far, falling back to the newest stored email
+        since_uid, uid_validity = conn.execute('''
+            SELECT COALESCE((SELECT last_uid FROM sync_state WHERE id = 1), (SELECT MAX(uid_int) FROM emails)),
+                   (SELECT uid_validity FROM sync_state WHERE id = 1)
+        ''').fetchone()
+    except sqlite3.Error as e:
+        return 0, str(e)
+    result = fetch_emails_from_server(limit=limit, since_uid=since_uid, mail=mail, uid_validity=uid_validity)
+    if 'error' in result:
+        return 0, result['error']
+    emails = result['emails']
+    # An unknown UIDVALIDITY is never treated as a change, that would throw away local stars
+    validity_changed = (uid_validity is not None and result['uid_validity'] is not None
+                        and result['uid_validity'] != uid_validity)
+    record_validity = result['uid_validity'] is not None and result['uid_validity'] != uid_validity
+
+    # One timestamp for the whole batch rather than formatting one per email
+    created_at = datetime.now().isoformat()
+    # Bodies are stored zlib-compressed, with a short plain preview for the list view
+    rows = []
+    for e in emails:
+        row = (e['email_id'], int(e['email_id']), e['subject'], e['sender'], e['date'], e['body'][:PREVIEW_CHARS],
+               zlib.compress(e['body'].encode('utf-8')), e['is_read'], e['is_starred'], created_at)
+        # One value sqlite cannot bind would roll back the whole batch, so skip just that email
+        if all(value is None or isinstance(value, (str, int, bytes)) for value in row):
+            rows.append(row)
+        else:
+            logger.warning(f"Skipping email {e['email_id']} with unsupported field types")
+    # Skipped emails still move the watermark, otherwise every sync would retry them
+    last_uid = max((int(e['email_id']) for e in emails), default=None)
 
-        new_count = 0
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        for email_data in emails:
+    try:
+        # Insert the whole batch in one transaction with a single prepared statement
+        conn.execute('BEGIN IMMEDIATE')
+        if validity_changed:
+            # Stored UIDs now point at different messages, start over
+            print(f"[Vexmail] UIDVALIDITY changed ({uid_validity} -> {result['uid_validity']}), clearing stored emails")
+            conn.execute('DELETE FROM emails')
+        # We can now rely on email_id being a unique UID
+        cursor = conn.executemany('INSERT OR IGNORE INTO emails (email_id, uid_int, subject, sender, date, preview, body_z, is_read, is_starred, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        # rowcount is summed across executemany, ignored rows count as 0
+        new_count = max(cursor.rowcount, 0)
+        if last_uid is not None or record_validity:
+            # The watermark only carries over while UIDVALIDITY is unchanged
+            conn.execute('''
+                INSERT INTO sync_state (id, last_uid, uid_validity) VALUES (1, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    last_uid = CASE WHEN excluded.uid_validity IS NULL OR uid_validity IS excluded.uid_validity
+                                    THEN MAX(COALESCE(last_uid, 0), excluded.last_uid)
+                                    ELSE excluded.last_uid END,
+                    uid_validity = COALESCE(excluded.uid_validity, uid_validity)
+            ''', (last_uid, result['uid_validity']))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        return 0, str(e)
+
+    # Formatted once here rather than on every API response
+    last_sync_time = datetime.now().isoformat()
+    return new_count, None
+
+def wait_for_new_mail(mail, timeout):
+    """Wait on the selected inbox until new mail arrives or timeout passes
+
+    Returns True if the server reported new messages. Uses IMAP IDLE where
+    imaplib supports it, otherwise polls with NOOP.
+    """
+    if hasattr(mail, 'idle'):
+        # Leaving the block sends DONE and reads the tagged reply
+        with mail.idle(duration=timeout) as responses:
+            for response_type, data in responses:
+                if response_type == 'EXISTS':
+                    return True
+        return False
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(min(NOOP_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+        mail.noop()
+        # New messages show up as an untagged EXISTS in the NOOP response
+        if mail.response('EXISTS')[1] != [None]:
+            return True
+    return False
+
+def idle_watcher():
+    """Keep one IMAP connection in IDLE and sync over it as soon as mail arrives"""
+    while True:
+        mail = connect_to_imap()
+        if not mail:
+            time.sleep(IDLE_RETRY_SECONDS)
+            continue
+        try:
+            # Catch up on anything that arrived while we were disconnected
+            sync_emails_internal(mail=mail, wait=True)
+            while True:
+                if wait_for_new_mail(mail, IDLE_REFRESH_SECONDS):
+                    new_count, error = sync_emails_internal(mail=mail, wait=True)
+                    if error:
+                        logger.error(f"IDLE sync failed: {error}")
+                    else:
+                        logger.info(f"IDLE sync stored {new_count} new emails")
+        except Exception as e:
+            # Anything else would end the thread for good and leak the connection
+            logger.warning(f"IMAP IDLE watcher failed ({e!r}), reconnecting")
             try:
-                # We can now rely on email_id being a unique UID
-                cursor.execute('INSERT OR IGNORE INTO emails (email_id, subject, sender, date, body, is_read, is_starred, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                    (email_data['email_id'], email_data['subject'], email_data['sender'], email_data['date'], email_data['body'], email_data['is_read'], email_data['is_starred'], email_data['created_at']))
-                if cursor.rowcount > 0:
-                    new_count += 1
-            except:
-                continue
-        
+                mail.logout()
+            except Exception:
+                pass
+            time.sleep(IDLE_RETRY_SECONDS)
+
+def start_idle_watcher():
+    """Start the background IMAP IDLE watcher"""
+    threading.Thread(target=idle_watcher, daemon=True).start()
+
+def run_sync_job(job_id):
+    """Run a queued sync and record its outcome"""
+    with sync_jobs_lock:
+        job = sync_jobs.get(job_id)
+    if job is None:
+        return
+    job['status'] = 'running'
+    try:
+        new_count, error = sync_emails_internal()
+    except Exception as e:
+        # A job left 'running' would keep the page polling forever
+        new_count, error = 0, str(e)
+    if error:
+        job.update(status='failed', error=error)
+    elif new_count is None:
+        job.update(status='skipped', message='Sync already running')
+    else:
+        job.update(status='done', new_count=new_count, message=f'Synced {new_count} new emails')
+
+def queue_sync_job():
+    """Queue a background sync and return its job id
+
+    Reuses the id of a sync that is already queued or running instead of queueing another.
+    """
+    with sync_jobs_lock:
+        for job_id, job in sync_jobs.items():
+            if job['status'] in ('queued', 'running'):
+                return job_id
+        job_id = uuid.uuid4().hex
+        sync_jobs[job_id] = {'status': 'queued', 'new_count': 0, 'message': None, 'error': None}
+        # Forget the oldest finished jobs once we're tracking too many, never ones still being polled
+        finished = [old_id for old_id, job in sync_jobs.items() if job['status'] not in ('queued', 'running')]
+        for old_id in finished[:len(sync_jobs) - MAX_SYNC_JOBS]:
+            del sync_jobs[old_id]
+    sync_executor.submit(run_sync_job, job_id)
+    return job_id
+
+def flush_read_marks():
+    """Write any buffered mark-as-read updates in one statement"""
+    # Held across the write so readers never see a half-finished flush
+    with read_marks_flush_lock:
+        with read_marks_cond:
+            if not read_marks:
+                return
+            ids = list(read_marks)
+            read_marks.clear()
+        conn = get_db_connection()
+        conn.execute('UPDATE emails SET is_read = 1 WHERE is_read = 0 AND id IN (SELECT value FROM json_each(?))',
+                     (orjson.dumps(ids).decode(),))
         conn.commit()
-        conn.close()
-        last_sync_time = datetime.now()
-        return new_count, None
+
+def mark_read_later(email_db_id):
+    """Queue an email to be marked read, or mark it now when buffering is off"""
+    if not BUFFER_READ_MARKS:
+        conn = get_db_connection()
+        conn.execute('UPDATE emails SET is_read = 1 WHERE id = ? AND is_read = 0', (email_db_id,))
+        conn.commit()
+        return
+    with read_marks_cond:
+        was_empty = not read_marks
+        read_marks.add(email_db_id)
+        if was_empty or len(read_marks) >= READ_FLUSH_SIZE:
+            read_marks_cond.notify()
+
+def read_marks_worker():
+    """Flush buffered read marks every READ_FLUSH_INTERVAL or once the buffer fills"""
+    while True:
+        with read_marks_cond:
+            while not read_marks:
+                read_marks_cond.wait()
+            # Let more clicks collect unless the buffer is already full
+            if len(read_marks) < READ_FLUSH_SIZE:
+                read_marks_cond.wait(READ_FLUSH_INTERVAL)
+        try:
+            flush_read_marks()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to flush read marks: {e}")
+
+if BUFFER_READ_MARKS:
+    threading.Thread(target=read_marks_worker, daemon=True).start()
 
 @app.route('/')
 def index():
     """Main page"""
     return render_template('index.html')
 
+def conditional_response(response):
+    """Tag a response with an ETag and answer 304 Not Modified if the client already has it
+
+    The tag is weak so Flask-Compress leaves it alone, one tag then covers
+    every encoding of the same JSON.
+    """
+    response.add_etag(weak=True)
+    return response.make_conditional(request)
+
+def query_email_page(conn, before):
+    """Fetch one page of the email list, starting below the UID before if given"""
+    # Sort by numeric UID DESC to ensure strictly latest emails first
+    # Only the columns the list view renders, plus the stored body preview
+    if before is None:
+        rows = conn.execute('''
+            SELECT id, email_id, subject, sender, date, is_read, is_starred, preview
+            FROM emails ORDER BY uid_int DESC LIMIT ?
+        ''', (PAGE_SIZE,))
+    else:
+        # Seek straight to the cursor on the UID index instead of skipping rows with OFFSET
+        rows = conn.execute('''
+            SELECT id, email_id, subject, sender, date, is_read, is_starred, preview
+            FROM emails WHERE uid_int < ? ORDER BY uid_int DESC LIMIT ?
+        ''', (before, PAGE_SIZE))
+    return [dict(row) for row in rows]
+
 @app.route('/api/emails')
 def get_emails():
-    """Get all emails from SQLite"""
+    """Get a page of emails from SQLite, older pages via ?before=<uid>"""
     try:
+        before = request.args.get('before')
+        if before is not None:
+            if not UID_CURSOR_PATTERN.fullmatch(before):
+                return jsonify({'success': False, 'error': 'before must be an email UID'}), 400
+            before = int(before)
+        flush_read_marks()
         conn = get_db_connection()
-        cursor = conn.cursor()
-        # Sort by UID (email_id) DESC to ensure strictly latest emails first
-        cursor.execute('SELECT * FROM emails ORDER BY CAST(email_id AS INTEGER) DESC LIMIT 50')
-        rows = cursor.fetchall()
-        emails = [dict(row) for row in rows]
-        conn.close()
+        if before is None:
+            # Reuse this thread's first page, the one clients poll, until something writes to the database
+            version = get_db_version(conn)
+            cached = getattr(db_local, 'first_page', None)
+            if cached and cached[0] == version:
+                emails = cached[1]
+            else:
+                emails = query_email_page(conn, None)
+                db_local.first_page = (version, emails)
+        else:
+            emails = query_email_page(conn, before)
         
-        return jsonify({
+        return conditional_response(jsonify({
             'success': True,
             'emails': emails,
             'count': len(emails),
-            'last_sync': last_sync_time.isoformat() if last_sync_time else None
-        })
+            # Pass back as ?before= to get the next page, None on the last one
+            'next_before': int(emails[-1]['email_id']) if len(emails) == PAGE_SIZE else None,
+            'last_sync': last_sync_time
+        }))
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -240,18 +779,20 @@ def get_email(email_db_id):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM emails WHERE id = ?', (email_db_id,))
+        cursor.execute('''
+            SELECT id, email_id, subject, sender, date, body, body_z, is_read, is_starred, created_at
+            FROM emails WHERE id = ?
+        ''', (email_db_id,))
         row = cursor.fetchone()
         
         if row:
-            # Mark as read
-            cursor.execute('UPDATE emails SET is_read = 1 WHERE id = ?', (email_db_id,))
-            conn.commit()
+            # Mark as read, written in the background and skipped when already read
+            if not row['is_read']:
+                mark_read_later(email_db_id)
             email_data = dict(row)
-            conn.close()
+            email_data['body'] = email_body(email_data.pop('body_z'), email_data['body'])
             return jsonify({'success': True, 'email': email_data})
         else:
-            conn.close()
             return jsonify({'success': False, 'error': 'Email not found'}), 404
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -264,22 +805,52 @@ def sync_emails():
         # In production, you'd check for a secret token
         pass
 
+    # Manual syncs run in the background so the request returns immediately
+    if request.method == 'POST' and BACKGROUND_SYNC:
+        job_id = queue_sync_job()
+        return jsonify({'success': True, 'status': 'queued', 'job_id': job_id}), 202
+
     new_count, error = sync_emails_internal()
     if error:
         return jsonify({'success': False, 'error': error}), 500
+    if new_count is None:
+        return jsonify({'success': True, 'status': 'skipped', 'message': 'Sync already running', 'new_count': 0})
 
     return jsonify({'success': True, 'message': f'Synced {new_count} new emails', 'new_count': new_count})
 
+@app.route('/api/sync/status')
+def get_sync_status():
+    """Report whether a sync is running and when the last one finished"""
+    return jsonify({
+        'success': True,
+        'running': sync_lock.locked(),
+        'last_sync': last_sync_time
+    })
+
+@app.route('/api/sync/<job_id>')
+def get_sync_job(job_id):
+    """Get the status of a background sync"""
+    job = sync_jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Sync job not found'}), 404
+    return jsonify({'success': True, 'job_id': job_id, **job})
+
+def get_json_body():
+    """Parse the request body once with orjson, None unless it is a JSON object"""
+    data = request.get_json(silent=True, cache=False)
+    return data if isinstance(data, dict) else None
+
 @app.route('/api/emails/<int:email_db_id>/star', methods=['POST'])
 def toggle_star(email_db_id):
     """Toggle star status"""
     try:
-        data = request.get_json()
+        data = get_json_body()
+        if data is None:
+            return jsonify({'success': False, 'error': 'Request body must be a JSON object'}), 400
         is_starred = 1 if data.get('is_starred', False) else 0
         conn = get_db_connection()
         conn.execute('UPDATE emails SET is_starred = ? WHERE id = ?', (is_starred, email_db_id))
         conn.commit()
-        conn.close()
         return jsonify({'success': True, 'is_starred': bool(is_starred)})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -288,36 +859,79 @@ def toggle_star(email_db_id):
 def toggle_read(email_db_id):
     """Toggle read status"""
     try:
-        data = request.get_json()
+        data = get_json_body()
+        if data is None:
+            return jsonify({'success': False, 'error': 'Request body must be a JSON object'}), 400
         is_read = 1 if data.get('is_read', False) else 0
+        # Apply buffered read marks first so they can't undo this change
+        flush_read_marks()
         conn = get_db_connection()
         conn.execute('UPDATE emails SET is_read = ? WHERE id = ?', (is_read, email_db_id))
         conn.commit()
-        conn.close()
         return jsonify({'success': True, 'is_read': bool(is_read)})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def bulk_update_flag(flag):
+    """Set is_read or is_starred on many emails with a single UPDATE"""
+    try:
+        data = get_json_body()
+        if data is None:
+            return jsonify({'success': False, 'error': 'Request body must be a JSON object'}), 400
+        ids = data.get('ids')
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({'success': False, 'error': 'ids must be a non-empty list of email ids'}), 400
+
+        value = 1 if data.get(flag, False) else 0
+        # Apply buffered read marks first so they can't undo this change
+        flush_read_marks()
+        conn = get_db_connection()
+        # json_each keeps this one statement no matter how many ids are sent
+        cursor = conn.execute(f'UPDATE emails SET {flag} = ? WHERE id IN (SELECT value FROM json_each(?))',
+                              (value, orjson.dumps(ids).decode()))
+        conn.commit()
+        return jsonify({'success': True, flag: bool(value), 'updated': cursor.rowcount})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/emails/read', methods=['POST'])
+def bulk_toggle_read():
+    """Set read status on several emails"""
+    return bulk_update_flag('is_read')
+
+@app.route('/api/emails/star', methods=['POST'])
+def bulk_toggle_star():
+    """Set star status on several emails"""
+    return bulk_update_flag('is_starred')
+
 @app.route('/api/stats')
 def get_stats():
     """Get statistics"""
     try:
+        flush_read_marks()
         conn = get_db_connection()
-        total = conn.execute('SELECT COUNT(*) FROM emails').fetchone()[0]
-        unread = conn.execute('SELECT COUNT(*) FROM emails WHERE is_read = 0').fetchone()[0]
-        starred = conn.execute('SELECT COUNT(*) FROM emails WHERE is_starred = 1').fetchone()[0]
-        conn.close()
-
-        return jsonify({
+        # Reuse this thread's last counts until something writes to the database
+        version = get_db_version(conn)
+        cached = getattr(db_local, 'stats', None)
+        if cached and cached[0] == version:
+            counts = cached[1]
+        else:
+            # One statement, each count is answered from an index rather than the table
+            counts = dict(conn.execute('''
+                SELECT (SELECT COUNT(*) FROM emails) AS total,
+                       (SELECT COUNT(*) FROM emails WHERE is_read = 0) AS unread,
+                       (SELECT COUNT(*) FROM emails WHERE is_starred = 1) AS starred
+            ''').fetchone())
+            db_local.stats = (version, counts)
+
+        return conditional_response(jsonify({
             'success': True,
             'stats': {
-                'total': total,
-                'unread': unread,
-                'starred': starred,
-                'last_sync': last_sync_time.isoformat() if last_sync_time else None,
+                **counts,
+                'last_sync': last_sync_time,
                 'account': EMAIL_USER
             }
-        })
+        }))
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -331,4 +945,15 @@ def health_check():
 
 if __name__ == '__main__':
     # When running locally
-    app.run(host='0.0.0.0', port=5000, debug=True)  # Run the app
\ No newline at end of file
+    if DEBUG:
+        # The reloader runs this twice, only the serving child should hold the IDLE connection
+        if IMAP_IDLE and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_idle_watcher()
+        app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)  # Run the app
+    else:
+        # Multi-threaded WSGI server so a slow request doesn't hold up the others
+        from waitress import serve
+        if IMAP_IDLE:
+            start_idle_watcher()
+        print(f"[Vexmail] Serving on http://0.0.0.0:5000 with {SERVER_THREADS} threads")
+        serve(app, host='0.0.0.0', port=5000, threads=SERVER_THREADS)
@@ -0,0 +1,68 @@
+import base64
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app creates its database relative to the working directory on import
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    import app
+finally:
+    os.chdir(_cwd)
+
+HEADER = (b'Subject: Long\r\nFrom: Bob <bob@example.com>\r\n'
+          b'Date: Mon, 1 Jan 2024 10:00:00 +0000\r\nMIME-Version: 1.0\r\n')
+TEXT = ''.join(f'Line {i} of a long message with café in it.\n' for i in range(600))
+
+
+def base64_body(text):
+    return base64.encodebytes(text.encode('utf-8')).replace(b'\n', b'\r\n')
+
+
+def test_cut_base64_body_is_decoded():
+    header = HEADER + b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+    body = base64_body(TEXT)
+    assert len(body) > app.BODY_FETCH_BYTES
+    for cut in range(app.BODY_FETCH_BYTES - 80, app.BODY_FETCH_BYTES):
+        parsed = app.parse_email(b'1', [], header, body[:cut])
+        assert parsed['body'].startswith('Line 0 of a long message with café'), cut
+        assert TEXT.startswith(parsed['body']), cut
+
+
+def test_cut_base64_part_in_multipart_is_decoded():
+    header = HEADER + b'Content-Type: multipart/mixed; boundary="b"\r\n'
+    body = (b'--b\r\nContent-Type: text/plain; charset=utf-8\r\n'
+            b'Content-Transfer-Encoding: base64\r\n\r\n' + base64_body(TEXT))
+    for cut in range(app.BODY_FETCH_BYTES - 80, app.BODY_FETCH_BYTES):
+        parsed = app.parse_email(b'1', [], header, body[:cut])
+        assert parsed['body'].startswith('Line 0 of a long message'), cut
+
+
+def test_cut_quoted_printable_escape_is_dropped():
+    header = HEADER + b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+    for tail in (b'caf=C3=A9 =', b'caf=C3=A9 =C'):
+        parsed = app.parse_email(b'1', [], header, tail)
+        assert parsed['body'] == 'café '
+
+
+def test_non_text_charset_falls_back_to_utf8():
+    assert app.decode_email_header('=?base64?q?Caf=C3=A9?=') == 'Café'
+    assert app.decode_email_header('=?hex?q?Hi?=') == 'Hi'
+    header = HEADER.replace(b'Subject: Long', b'Subject: =?base64?q?Caf=C3=A9?=') + b'Content-Type: text/plain; charset=hex\r\n\r\n'
+    parsed = app.parse_email(b'1', [], header, b'plain body')
+    assert parsed['subject'] == 'Café'
+    assert parsed['body'] == 'plain body'
+
+
+def test_raw_8bit_headers_are_decoded_to_text():
+    header = (b'Subject: Caf\xc3\xa9\r\nFrom: Ren\xc3\xa9 <rene@example.com>\r\n'
+              b'Date: Lun, 1 janv. 2024 10:00:00 +0000 (heure d\xe9t\xe9)\r\n\r\n')
+    parsed = app.parse_email(b'1', [], header, b'plain body')
+    for field in ('subject', 'sender', 'date'):
+        assert isinstance(parsed[field], str), field
+    assert parsed['subject'] == 'Café'
+    assert parsed['date'].startswith('Lun, 1 janv. 2024')
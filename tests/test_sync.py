@@ -0,0 +1,234 @@
+import os
+import sys
+import tempfile
+import threading
+from email.header import Header
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app creates its database relative to the working directory on import
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    import app
+finally:
+    os.chdir(_cwd)
+
+
+@pytest.fixture(autouse=True)
+def fresh_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DB_PATH', str(tmp_path / 'vexmail.db'))
+    monkeypatch.setattr(app, 'db_local', threading.local())
+    app.init_db()
+    yield
+    app.db_local.conn.close()
+
+
+class FakeIMAP:
+    """Just enough of an imaplib connection for UID SEARCH and UID FETCH"""
+
+    def __init__(self, uid_validity=7, text_first=False):
+        self.uid_validity = uid_validity
+        self.text_first = text_first
+        self.messages = {}
+        self.searches = []
+
+    def add(self, uid, flags=b'', body='Hello there'):
+        header = (f'Subject: Message {uid}\r\nFrom: bob@example.com\r\n'
+                  'Date: Mon, 1 Jan 2024 10:00:00 +0000\r\n\r\n').encode()
+        self.messages[uid] = (flags, header, body.encode())
+
+    def uid(self, command, *args):
+        if command == 'search':
+            criteria = args[1]
+            self.searches.append(criteria)
+            uids = sorted(self.messages)
+            if criteria != 'ALL':
+                low = int(criteria.split()[1].split(':')[0])
+                # Like real servers, "n:*" always matches the newest message
+                uids = [uid for uid in uids if uid >= low] or uids[-1:]
+            return 'OK', [b' '.join(str(uid).encode() for uid in uids)]
+        spec = args[0]
+        data = []
+        for seq, uid in enumerate((int(uid) for uid in spec.split(b',')), 1):
+            flags, header, text = self.messages[uid]
+            literals = [(b'BODY[HEADER.FIELDS (SUBJECT FROM DATE)] {%d}' % len(header), header),
+                        (b'BODY[TEXT]<0> {%d}' % len(text), text)]
+            if self.text_first:
+                literals.reverse()
+            start = b'%d (UID %d FLAGS (%s) ' % (seq, uid, flags)
+            data.append((start + literals[0][0], literals[0][1]))
+            data.append((b' ' + literals[1][0], literals[1][1]))
+            data.append(b')')
+        return 'OK', data
+
+
+def make_email(uid, **fields):
+    email = {'email_id': str(uid), 'subject': f'Message {uid}', 'sender': 'bob@example.com',
+             'date': 'Mon, 1 Jan 2024 10:00:00 +0000', 'body': f'Body {uid}', 'is_read': 0, 'is_starred': 0}
+    email.update(fields)
+    return email
+
+
+def stored_uids():
+    return [row[0] for row in app.get_db_connection().execute('SELECT uid_int FROM emails ORDER BY uid_int')]
+
+
+def sync_state():
+    return tuple(app.get_db_connection().execute('SELECT last_uid, uid_validity FROM sync_state').fetchone())
+
+
+def test_unbindable_row_does_not_block_the_batch(monkeypatch):
+    emails = [make_email(1), make_email(2, date=Header(b'bad \xe9', 'unknown-8bit')), make_email(3)]
+    monkeypatch.setattr(app, 'fetch_emails_from_server',
+                        lambda **kwargs: {'uid_validity': 7, 'emails': emails})
+    assert app.sync_new_emails(50, None) == (2, None)
+    assert stored_uids() == [1, 3]
+    # The skipped email is not fetched again on the next sync
+    assert sync_state() == (3, 7)
+
+
+def test_sync_while_another_runs_is_reported_as_skipped():
+    with app.sync_lock:
+        response = app.app.test_client().get('/api/sync')
+        app.sync_jobs['job'] = {'status': 'queued', 'new_count': 0, 'message': None, 'error': None}
+        app.run_sync_job('job')
+    assert response.get_json()['status'] == 'skipped'
+    assert app.sync_jobs.pop('job')['status'] == 'skipped'
+
+
+def test_queue_sync_job_reuses_unfinished_job(monkeypatch):
+    monkeypatch.setattr(app, 'sync_jobs', {})
+    monkeypatch.setattr(app.sync_executor, 'submit', lambda *args: None)
+    job_id = app.queue_sync_job()
+    assert app.queue_sync_job() == job_id
+    app.sync_jobs[job_id]['status'] = 'running'
+    assert app.queue_sync_job() == job_id
+
+
+def test_queue_sync_job_only_evicts_finished_jobs(monkeypatch):
+    monkeypatch.setattr(app, 'sync_jobs', {})
+    monkeypatch.setattr(app.sync_executor, 'submit', lambda *args: None)
+    for i in range(app.MAX_SYNC_JOBS):
+        app.sync_jobs[f'old{i}'] = {'status': 'done', 'new_count': 0, 'message': None, 'error': None}
+    job_id = app.queue_sync_job()
+    assert len(app.sync_jobs) == app.MAX_SYNC_JOBS
+    assert 'old0' not in app.sync_jobs
+    assert app.sync_jobs[job_id]['status'] == 'queued'
+
+
+def test_idle_watcher_reconnects_after_unexpected_error(monkeypatch):
+    class Stop(BaseException):
+        pass
+
+    class Mail:
+        logged_out = False
+
+        def logout(self):
+            self.logged_out = True
+
+    connections = [Mail(), Mail()]
+
+    def connect():
+        if not connections:
+            raise Stop
+        return connections[0]
+
+    def wait_for_new_mail(mail, timeout):
+        connections.pop(0)
+        raise ValueError('unexpected')
+
+    monkeypatch.setattr(app, 'connect_to_imap', connect)
+    monkeypatch.setattr(app, 'sync_emails_internal', lambda **kwargs: (0, None))
+    monkeypatch.setattr(app, 'wait_for_new_mail', wait_for_new_mail)
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+    first = connections[0]
+    with pytest.raises(Stop):
+        app.idle_watcher()
+    assert first.logged_out
+
+
+def test_watermark_read_error_fails_the_job():
+    app.get_db_connection().execute('DROP TABLE sync_state')
+    new_count, error = app.sync_new_emails(50, None)
+    assert new_count == 0 and 'sync_state' in error
+    app.sync_jobs['job'] = {'status': 'queued', 'new_count': 0, 'message': None, 'error': None}
+    app.run_sync_job('job')
+    job = app.sync_jobs.pop('job')
+    assert job['status'] == 'failed'
+    assert 'sync_state' in job['error']
+
+
+def test_only_uids_above_the_watermark_are_fetched():
+    mail = FakeIMAP()
+    for uid in (1, 2, 3):
+        mail.add(uid)
+    assert app.sync_new_emails(50, mail) == (3, None)
+    assert mail.searches == ['ALL']
+
+    mail.add(4)
+    mail.add(5)
+    assert app.sync_new_emails(50, mail) == (2, None)
+    assert mail.searches[-1] == 'UID 4:*'
+    # "6:*" still matches UID 5, which must not count as new
+    assert app.sync_new_emails(50, mail) == (0, None)
+    assert mail.searches[-1] == 'UID 6:*'
+    assert stored_uids() == [1, 2, 3, 4, 5]
+    assert sync_state() == (5, 7)
+
+
+def test_uid_validity_change_clears_stored_emails():
+    mail = FakeIMAP(uid_validity=7)
+    for uid in (10, 11):
+        mail.add(uid)
+    app.sync_new_emails(50, mail)
+
+    renumbered = FakeIMAP(uid_validity=8)
+    renumbered.add(1)
+    assert app.sync_new_emails(50, renumbered) == (1, None)
+    assert renumbered.searches == ['ALL']
+    assert stored_uids() == [1]
+    assert sync_state() == (1, 8)
+
+
+def test_unknown_uid_validity_keeps_stored_emails():
+    mail = FakeIMAP(uid_validity=7)
+    for uid in (10, 11):
+        mail.add(uid)
+    app.sync_new_emails(50, mail)
+
+    unknown = FakeIMAP(uid_validity=None)
+    for uid in (10, 11, 12):
+        unknown.add(uid)
+    assert app.sync_new_emails(50, unknown) == (1, None)
+    assert unknown.searches == ['UID 12:*']
+    assert stored_uids() == [10, 11, 12]
+    assert sync_state() == (12, 7)
+
+
+def test_seen_flag_is_imported_as_read():
+    mail = FakeIMAP()
+    mail.add(1, flags=b'\\Seen \\Answered')
+    mail.add(2)
+    app.sync_new_emails(50, mail)
+    rows = app.get_db_connection().execute('SELECT uid_int, is_read FROM emails ORDER BY uid_int').fetchall()
+    assert [tuple(row) for row in rows] == [(1, 1), (2, 0)]
+
+
+@pytest.mark.parametrize('text_first', [False, True])
+def test_fetch_literals_are_matched_in_either_order(text_first):
+    mail = FakeIMAP(text_first=text_first)
+    mail.add(1, flags=b'\\Seen', body='First body')
+    mail.add(2, body='Second body')
+    status, data = mail.uid('fetch', b'1,2', app.FETCH_ITEMS)
+    messages = list(app.iter_fetch_response(data))
+    assert [(uid, flags, text) for uid, flags, header, text in messages] == [
+        (b'1', [b'\\Seen'], b'First body'), (b'2', [], b'Second body')]
+    assert all(header.startswith(b'Subject: Message') for uid, flags, header, text in messages)
+
+    app.sync_new_emails(50, mail)
+    rows = app.get_db_connection().execute('SELECT subject, preview FROM emails ORDER BY uid_int').fetchall()
+    assert [tuple(row) for row in rows] == [('Message 1', 'First body'), ('Message 2', 'Second body')]